@@ -4,66 +4,122 @@
 # Use Wikipedia to get ambiguous content
 
 
-from __future__ import print_function
 from collections import defaultdict
+import threading
 import requests
+from requests.adapters import HTTPAdapter
 from mwlib import parser, uparser
+try:
+    import requests_cache
+except ImportError:
+    requests_cache = None
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 
-API_URL = 'http://en.wikipedia.org/w/api.php'
+API_URL = 'https://en.wikipedia.org/w/api.php'
 USER_AGENT = 'DisambigWiki (www.utk.edu)'
+CACHE_MAXAGE = 86400    # seconds that API responses may be cached
+
+# Session shared by all request threads so that connections to Wikipedia are kept alive and reused. If requests-cache
+# is installed, responses are also cached on disk so that reruns don't download the same pages again. When an expired
+# response has an ETag or Last-Modified header, it is revalidated with a conditional request, which lets an unchanged
+# page come back as a 304 without a body. Whether the API sends those headers for every query is not guaranteed.
+if requests_cache is not None:
+    _SESSION = requests_cache.CachedSession('disamwiki_cache', backend='sqlite', expire_after=CACHE_MAXAGE,
+                                            cache_control=True)
+else:
+    _SESSION = requests.Session()
+_SESSION.mount('https://', HTTPAdapter(pool_connections=16, pool_maxsize=32))
+
+# article title -> {section title: section number}. Each article has its own lock in _sections_locks so that its
+# sections are requested by only one thread; _sections_cache_lock guards _sections_locks.
+_sections_cache = {}
+_sections_locks = {}
+_sections_cache_lock = threading.Lock()
+
+# (search title, section) -> first article requested with them. Shared by all request threads.
+_article_cache = {}
+_article_cache_lock = threading.Lock()
 
 
 class Article:
     # ignore sections with these titles
-    ignoreSections=('See also', 'References', 'Further reading', 'External links', 'Footnotes', 'Notes',
-                    'Other', 'Other uses')
+    ignoreSections=frozenset(['See also', 'References', 'Further reading', 'External links', 'Footnotes', 'Notes',
+                              'Other', 'Other uses'])
 
     def __init__(self, pageid, search_title, title, wikitext, parent=None):
-        self.parent = parent
+        self.parent = None
+        self._level = 0
+        self._hierarchy = None
+        if parent is not None:
+            self.set_parent(parent)
         self.search_title = search_title
         self.title = title
         self.pageid = pageid
         self.wikitext = wikitext
-        self.children = defaultdict(list) # key is a link name and value is list of aritcles linked from link name
-        self.parsetree = None
+        # The children are stored as two parallel lists: the link name at index i linked the child article at index i
+        self._linknames = []
+        self._childarticles = []
+        self._children = None   # linkname -> [articles linked by linkname], built when first requested
+        self._childrenlock = threading.Lock()
         self.links = None
         self.plaintext = None
 
 
     def __iter__(self):
-        for x in self.children:
+        for x in dict.fromkeys(self._linknames):
             yield x
 
 
     def parse(self):
         """ Create a parse tree and then extract data for article from it. """
-        # if the page was missing, return
-        if self.missing():
+        # if the page was missing, has no wikitext or is already parsed, return
+        if self.missing() or self.wikitext is None or self.plaintext is not None:
             return
 
-        self.parsetree = uparser.parseString(title=self.title, raw=self.wikitext)
-
-        text, links = get_text_and_links(self.parsetree, self.ignoreSections)
-        plaintext = u''.join(text)
-        # Remove newlines and spaces that occur at beginning of text
-        self.plaintext = plaintext.lstrip(' \n')
+        plaintext, links = parse_wikitext(self.title, self.wikitext, self.ignoreSections)
+        # links is set before plaintext, so an article whose plaintext is set is completely parsed (see copy)
         self.links = links
+        self.plaintext = plaintext
+
+
+    def copy(self):
+        """ Return a new article with the same Wikipedia data and parse results as this article, but without a parent
+        or children. This allows the same page to appear at several places in the article hierarchy without requesting
+        or parsing it again.
+        """
+        article = Article(self.pageid, self.search_title, self.title, self.wikitext)
+        # Another thread may be storing the parse results of this article. They are stored links first, so read
+        # plaintext first: if it is set, links is set too. Otherwise the copy is left unparsed and is parsed again.
+        plaintext = self.plaintext
+        if plaintext is not None:
+            article.links = self.links
+            article.plaintext = plaintext
+        return article
 
 
     def set_parent(self, parent):
         self.parent = parent
+        self._level = parent._level + 1
+        self._hierarchy = None
 
 
     def get_children(self, childrenonly=False):
-        """ If childrenonly is True, return a list of the article's children. Otherwise, return the dictionary
-        that has the form:   linkname -> [list of articles linked by linkname]
+        """ If childrenonly is True, return a list of the article's children (the list should not be modified).
+        Otherwise, return the dictionary that has the form:   linkname -> [list of articles linked by linkname]
         """
         if childrenonly is False:
-            return self.children
+            if self._children is None:
+                children = defaultdict(list)
+                for linkname, childarticle in zip(self._linknames, self._childarticles):
+                    children[linkname].append(childarticle)
+                self._children = children
+            return self._children
         else:
-            children = [child for childlist in self.children.values() for child in childlist]
-            return children
+            return self._childarticles
 
 
     def add_children(self, childarticle, linknames):
@@ -71,8 +127,12 @@ class Article:
         that different linknames will share the same instance of childarticle.
         linknames - list of link names
         """
-        for linkname in linknames:
-            self.children[linkname].append(childarticle)
+        # Several request threads can add children to the same article, so the two lists are updated under a lock
+        with self._childrenlock:
+            for linkname in linknames:
+                self._linknames.append(linkname)
+                self._childarticles.append(childarticle)
+            self._children = None
 
 
     def get_title(self):
@@ -94,13 +154,7 @@ class Article:
 
     def get_level(self):
         """ Get level of page in page hierarchy. level 0 = root node """
-        page = self
-        level = 0
-        while page.parent is not None:
-            page = page.parent
-            level += 1
-
-        return level
+        return self._level
 
 
     def get_plaintext(self):
@@ -113,6 +167,9 @@ class Article:
 
         Format of string: i.e. parent1 --> parent2 --> this page
         """
+        if self._hierarchy is not None:
+            return self._hierarchy
+
         page = self
         reversedhierarchy = [page.get_title() or page.get_search_title()]
         while page.parent is not None:
@@ -120,8 +177,9 @@ class Article:
             page = page.parent
         # reverse the list so that the order of parents is logical
         hierarchy = reversedhierarchy[::-1]
+        self._hierarchy = ' --> '.join(hierarchy)
 
-        return ' --> '.join(hierarchy)
+        return self._hierarchy
 
 
     def missing(self):
@@ -142,22 +200,49 @@ def get_articles(search_titles, section=None):
     if len(search_titles) == 0:
         return None
 
+    # Titles that were already requested are copied from the cache, only the others are requested from Wikipedia
+    with _article_cache_lock:
+        cached = dict((t, _article_cache[(t, section)]) for t in search_titles if (t, section) in _article_cache)
+    newtitles = [t for t in search_titles if t not in cached]
+    newarticles = _request_articles(newtitles, section) if newtitles else []
+    with _article_cache_lock:
+        for search_title, article in zip(newtitles, newarticles):
+            _article_cache.setdefault((search_title, section), article)
+
+    newarticles = iter(newarticles)
+    return [cached[t].copy() if t in cached else next(newarticles) for t in search_titles]
+
+
+def _request_articles(search_titles, section):
+    """ Request the articles with the given search titles from Wikipedia. See get_articles. """
     params = dict(action='query', prop='revisions', rvexpandtemplates='', rvprop='content', redirects='')
-    params['titles'] = u'|'.join(search_titles)
+    params['titles'] = '|'.join(search_titles)
     if section is not None:
         params['rvsection'] = section
 
     # get data from Wikipedia API
     request = _wikirequest(params)
+    # If too many titles were requested at once, split the titles in half and try again
+    if request.get('error', {}).get('code') == 'toomanyvalues' and len(search_titles) > 1:
+        half = len(search_titles) // 2
+        return _request_articles(search_titles[:half], section) + _request_articles(search_titles[half:], section)
     query = request['query']
 
+    # If the response hit the API's result size limit, the remaining revisions are requested by following 'continue'
+    # until the response is complete.
+    pages = list(query['pages'])
+    while 'continue' in request:
+        params.update(request['continue'])
+        request = _wikirequest(params)
+        pages.extend(request['query']['pages'])
+
     norms = dict((n['from'], n['to']) for n in query.get('normalized', []))
     redirects = dict((r['from'], r) for r in query.get('redirects', []))
     articledata = []
 
     # Resolve normalizations and redirects
     for search_title in search_titles:
-        article = {'search_title': search_title, 'title': search_title, 'tofragment': None, 'pageid':None, 'wikitext':None}
+        article = {'search_title': search_title, 'title': search_title, 'tofragment': None, 'pageid':-1, 'wikitext':None}
         # Update title to normalized title if it exists
         if search_title in norms:
             article['title'] = norms[search_title]
@@ -172,10 +257,16 @@ def get_articles(search_titles, section=None):
 
         articledata.append(article)
 
-    for pageidstr, wikipage in query['pages'].items():
-        pageid = int(pageidstr)
+    # title -> all article data with that title
+    titledata = defaultdict(list)
+    for article in articledata:
+        titledata[article['title']].append(article)
+
+    for wikipage in pages:
+        # missing and invalid pages have no pageid
+        pageid = wikipage.get('pageid', -1)
         # for all articles that have the title of the wikipage
-        articlematch = [a for a in articledata if a['title'] == wikipage['title']]
+        articlematch = titledata.get(wikipage['title'], ())
         for article in articlematch:
             article['pageid'] = pageid
 
@@ -185,16 +276,25 @@ def get_articles(search_titles, section=None):
 
         # get the wikitext
         if 'revisions' in wikipage:
-            if '*' in wikipage['revisions'][0]:
+            if 'content' in wikipage['revisions'][0]:
                 for article in articlematch:
-                    article['wikitext'] = wikipage['revisions'][0]['*']
+                    article['wikitext'] = wikipage['revisions'][0]['content']
+
+    # A page whose content could not be retrieved is treated as missing
+    for article in articledata:
+        if article['wikitext'] is None:
+            article['pageid'] = -1
+
+    # If an article was a redirect to a fragment, we need to request the article fragment. All of the fragments are
+    # requested together.
+    fragmenttitles = ['{}#{}'.format(ar['title'], ar['tofragment']) for ar in articledata if ar['tofragment'] is not None]
+    fragments = iter(get_article_fragments(fragmenttitles))
 
     # Create Article instances from article data
     returnarticles = []
     for ar in articledata:
-        # If the article was a redirect to a fragment, we need to make two request the article fragment
         if ar['tofragment'] is not None:
-            article = get_article_fragment(ar['title'], ar['tofragment'])
+            article = next(fragments)
             article.search_title = ar['search_title']
         else:
             article = Article(ar['pageid'], ar['search_title'], ar['title'], ar['wikitext'])
@@ -203,49 +303,55 @@ def get_articles(search_titles, section=None):
     return returnarticles
 
 
-def get_article_section_number(articletitle, sectiontitle):
-    """ Returns the section number of sectiontitle in articletitle, or None if it does not exist.
+def get_article_sections(articletitle):
+    """ Returns a dictionary that maps each section title in articletitle to its section number. The result is cached,
+    so the sections of an article are only requested once from Wikipedia.
 
-        articletitle: title of article that contains the section
-        sectiontitle: title of section
+    articletitle: title of article that contains the sections
     """
-    params = dict(action='parse', prop='sections', redirects='', page=articletitle)
-
-    query = _wikirequest(params)
+    with _sections_cache_lock:
+        titlelock = _sections_locks.setdefault(articletitle, threading.Lock())
 
-    for section in query['parse']['sections']:
-        if section['line'] == sectiontitle:
-            return section['index']
+    # Other threads that need the sections of the same article wait here until they are in the cache
+    with titlelock:
+        sections = _sections_cache.get(articletitle)
+        if sections is None:
+            params = dict(action='parse', prop='sections', redirects='', page=articletitle)
+            query = _wikirequest(params)
+            sections = dict((section['line'], section['index']) for section in query.get('parse', {}).get('sections', []))
+            _sections_cache[articletitle] = sections
 
-    return None
+    return sections
 
 
-def get_article_fragment(articletitle, fragmenttitle):
-    """ Return the specified fragment/section of the given article. The search_title of the article will be set to
-    articletitle#fragmenttitle. If no such fragment exists, return an article with pageid < 0.
+def get_article_fragments(fragmenttitles):
+    """ Return the specified fragments/sections of articles, in the same order as fragmenttitles. The search_title
+    of each article will be set to article#fragment. If a fragment does not exist, an article with pageid < 0 is
+    returned in its place. Fragments that share a section number are requested together.
 
-    articletitle: title of article
-    fragmenttitle: title of fragment in article
+    fragmenttitles: list of titles of the form article#fragment
     """
-    # Get the section number of the fragment from Wikipedia
-    sectionnum = None
-
-    params = dict(action='parse', prop='sections', redirects='', page=articletitle)
-    query = _wikirequest(params)
-    for section in query['parse']['sections']:
-        if section['line'] == fragmenttitle:
-            sectionnum = section['index']
-
-    title = u'{}#{}'.format(articletitle, fragmenttitle)
-    # If the section number could not be found, return an article with pageid < 0
-    if sectionnum is None:
-        return Article(pageid=-1, search_title=title, title=None, wikitext=None, parent=None)
+    # Group the fragments by their section number
+    sectiontitles = defaultdict(list)
+    returnarticles = [None] * len(fragmenttitles)
+    for i, title in enumerate(fragmenttitles):
+        articletitle, hashtag, fragmenttitle = title.partition('#')
+        sectionnum = get_article_sections(articletitle).get(fragmenttitle)
+        # If the section number could not be found, return an article with pageid < 0
+        if sectionnum is None:
+            returnarticles[i] = Article(pageid=-1, search_title=title, title=None, wikitext=None, parent=None)
+        else:
+            sectiontitles[sectionnum].append((i, articletitle))
 
-    newarticle = get_articles([articletitle], sectionnum)[0]
-    newarticle.title = title
-    newarticle.search_title = title
+    # Get the sections from Wikipedia, one request per section number
+    for sectionnum, indextitles in sectiontitles.items():
+        articles = get_articles([articletitle for i, articletitle in indextitles], sectionnum)
+        for (i, articletitle), newarticle in zip(indextitles, articles):
+            newarticle.title = fragmenttitles[i]
+            newarticle.search_title = fragmenttitles[i]
+            returnarticles[i] = newarticle
 
-    return newarticle
+    return returnarticles
 
 
 def _wikirequest(params):
@@ -256,16 +362,98 @@ def _wikirequest(params):
     global USER_AGENT
     global API_URL
 
-    headers = {'USER_AGENT': USER_AGENT}
+    headers = {'User-Agent': USER_AGENT}
     params['format'] = 'json'
+    params['formatversion'] = '2'
+    # Allow Wikipedia and the local cache to serve cached responses
+    params['maxage'] = CACHE_MAXAGE
+    params['smaxage'] = CACHE_MAXAGE
 
-    result = requests.get(API_URL, params=params, headers=headers)
+    result = _SESSION.get(API_URL, params=params, headers=headers, timeout=30)
 
+    if orjson is not None:
+        return orjson.loads(result.content)
     return result.json()
 
 
-ignoreTypes = (parser.Table, parser.ImageLink, parser.CategoryLink, parser.NamespaceLink, parser.TagNode)
-def get_text_and_links(node, ignoreSections=None, text=None, links=None):
+def parse_wikitext(title, wikitext, ignoreSections):
+    """ Parse wikitext and return a tuple (plaintext, links). This is a module-level function so that it can be run in
+    another process.
+
+    title: title of the article the wikitext belongs to
+    wikitext: the wikitext to parse
+    ignoreSections: sections to ignore when extracting from the parsetree
+    """
+    parsetree = uparser.parseString(title=title, raw=wikitext)
+
+    text, links = get_text_and_links(parsetree, ignoreSections)
+    plaintext = ''.join(text)
+    # Remove newlines and spaces that occur at beginning of text
+    return plaintext.lstrip(' \n'), links
+
+
+def parse_articles(articles, pool=None):
+    """ Parse each article in articles. Missing articles, articles without wikitext and already parsed articles are
+    skipped.
+
+    articles: list of articles to parse
+    pool: if given, a multiprocessing.Pool whose worker processes parse the articles in parallel
+    """
+    if pool is None:
+        for article in articles:
+            article.parse()
+        return
+
+    articles = [a for a in articles if not a.missing() and a.wikitext is not None and a.plaintext is None]
+    results = [pool.apply_async(parse_wikitext, (a.title, a.wikitext, a.ignoreSections)) for a in articles]
+    for article, result in zip(articles, results):
+        plaintext, links = result.get()
+        # links is set before plaintext, so an article whose plaintext is set is completely parsed (see Article.copy)
+        article.links = links
+        article.plaintext = plaintext
+
+
+# Node types handled when extracting text and links from a parse tree
+_Text = parser.Text
+_Section = parser.Section
+_ArticleLink = parser.ArticleLink
+
+# Equal signs around a section heading, indexed by the level of the section
+_EQUALSIGNS = ['=' * level for level in range(7)]
+
+
+def _handle_text(node, text, links, ignoreSections):
+    text.append(node.asText())
+
+
+def _handle_section(node, text, links, ignoreSections):
+    # The first element in children contains the caption of the section as a Node
+    # instance with 0 or more children. Subsequent children are elements following
+    # the section heading.
+    headingNode = node.children.pop(0)
+    sectiontitle = headingNode.asText()
+    equalsign = _EQUALSIGNS[node.level]
+    text.extend((equalsign, ' ', sectiontitle, ' ', equalsign))
+    # If the section is to be ignored, remove all of the section's children an insert a newline into the text
+    if sectiontitle in ignoreSections:
+        text.append('\n')
+        node.children = []
+
+
+def _handle_link(node, text, links, ignoreSections):
+    # Article link has style [[target]] in wikitext
+    if len(node.children) == 0:
+        text.append(node.target)
+        links.append((node.target, node.target))
+    else:
+        linkparts = [c.asText() for c in node.allchildren() if isinstance(c, _Text)]
+        links.append((''.join(linkparts), node.target))
+        # links.append((node.asText(), node.target))
+
+
+_handlers = {_Text: _handle_text, _Section: _handle_section, _ArticleLink: _handle_link}
+ignoreTypes = frozenset([parser.Table, parser.ImageLink, parser.CategoryLink, parser.NamespaceLink, parser.TagNode])
+def get_text_and_links(node, ignoreSections=None):
     """ Extract the text and links from the parsetree that has node as root. This function modifies the
     input parse tree. The links are returned as a tuple (linkname, linktarget), where linkname is how the
     link appeared in the article and linktarget is that target article of the link.
@@ -273,40 +461,32 @@ def get_text_and_links(node, ignoreSections=None, text=None, links=None):
     node: root of parsetree
     ignoreSections: sections to ignore when extracting from the parsetree
     """
-    if text is None:
-        text = []
-    if links is None:
-        links = []
-
-    if type(node) is parser.Text:
-        text.append(node.asText())
-    elif type(node) is parser.Section:
-        # The first element in children contains the caption of the section as a Node
-        # instance with 0 or more children. Subsequent children are elements following
-        # the section heading.
-        headingNode = node.children.pop(0)
-        sectiontitle = headingNode.asText()
-        equalsign = '=' * node.level
-        text.append(u'{} {} {}'.format(equalsign, sectiontitle, equalsign))
-        # If the section is to be ignored, remove all of the section's children an insert a newline into the text
-        if sectiontitle in ignoreSections:
-            text.append('\n')
-            node.children = []
-    elif type(node) is parser.ArticleLink:
-        # Article link has style [[target]] in wikitext
-        if len(node.children) == 0:
-            text.append(node.target)
-            links.append((node.target, node.target))
-        else:
-            linkname = u''
-            for c in node.allchildren():
-                if isinstance(c, parser.Text):
-                    linkname += c.asText()
-            links.append((linkname, node.target))
-            # links.append((node.asText(), node.target))
-
-    if type(node) not in ignoreTypes:
-        for child in node.children:
-            get_text_and_links(child, ignoreSections, text, links)
-
-    return text, links
\ No newline at end of file
+    text = []
+    links = []
+
+    # Look up the globals and methods used in the loop only once
+    gethandler = _handlers.get
+    skiptypes = ignoreTypes
+    stack = [node]
+    pop = stack.pop
+    push = stack.extend
+
+    # Depth-first traversal of the parse tree. Children are pushed in reverse so that they are visited in order.
+    while stack:
+        node = pop()
+        nodetype = type(node)
+        if nodetype in skiptypes:
+            continue
+        handler = gethandler(nodetype)
+        if handler is not None:
+            handler(node, text, links, ignoreSections)
+        push(reversed(node.children))
+
+    return text, links
+
+
+# Use the compiled version of get_text_and_links if the extension was built (see setup.py)
+try:
+    from disamwiki_fast import get_text_and_links
+except ImportError:
+    pass
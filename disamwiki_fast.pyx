@@ -0,0 +1,68 @@
+# cython: language_level=3
+# disamwiki_fast.pyx
+#
+# Compiled version of disamwiki.get_text_and_links. disamwiki falls back to its pure Python version if this
+# extension has not been built. To build:
+#   python setup.py build_ext --inplace
+
+from mwlib import parser
+
+
+ignoreTypes = frozenset([parser.Table, parser.ImageLink, parser.CategoryLink, parser.NamespaceLink, parser.TagNode])
+
+cdef object _Text = parser.Text
+cdef object _Section = parser.Section
+cdef object _ArticleLink = parser.ArticleLink
+cdef frozenset _ignoreTypes = ignoreTypes
+
+# Equal signs around a section heading, indexed by the level of the section
+cdef list _EQUALSIGNS = ['=' * level for level in range(7)]
+
+
+cpdef tuple get_text_and_links(object node, object ignoreSections=None):
+    """ Extract the text and links from the parsetree that has node as root. This function modifies the
+    input parse tree. The links are returned as a tuple (linkname, linktarget), where linkname is how the
+    link appeared in the article and linktarget is that target article of the link.
+
+    node: root of parsetree
+    ignoreSections: sections to ignore when extracting from the parsetree
+    """
+    cdef list text = []
+    cdef list links = []
+    cdef list stack = [node]
+    cdef object nodetype, headingNode, child
+    cdef str sectiontitle, equalsign
+    cdef list linkparts
+
+    # Depth-first traversal of the parse tree. Children are pushed in reverse so that they are visited in order.
+    while stack:
+        node = stack.pop()
+        nodetype = type(node)
+        if nodetype in _ignoreTypes:
+            continue
+        if nodetype is _Text:
+            text.append(node.asText())
+        elif nodetype is _Section:
+            # The first element in children contains the caption of the section as a Node
+            # instance with 0 or more children. Subsequent children are elements following
+            # the section heading.
+            headingNode = node.children.pop(0)
+            sectiontitle = headingNode.asText()
+            equalsign = _EQUALSIGNS[node.level]
+            text.extend((equalsign, ' ', sectiontitle, ' ', equalsign))
+            # If the section is to be ignored, remove all of the section's children an insert a newline into the text
+            if sectiontitle in ignoreSections:
+                text.append('\n')
+                node.children = []
+        elif nodetype is _ArticleLink:
+            # Article link has style [[target]] in wikitext
+            if len(node.children) == 0:
+                text.append(node.target)
+                links.append((node.target, node.target))
+            else:
+                linkparts = [child.asText() for child in node.allchildren() if isinstance(child, _Text)]
+                links.append((''.join(linkparts), node.target))
+
+        stack.extend(reversed(node.children))
+
+    return text, links
@@ -1,23 +1,22 @@
 # main.py
 #
-from __future__ import print_function
-from __future__ import division
 from collections import defaultdict
 import os.path
 import argparse
-import time
 import sys
 import threading
-import Queue
+import multiprocessing
+import queue
 import disamwiki
 
 
 class Requests(threading.Thread):
     """Thread which gets data from Wikipedia."""
-    def __init__(self, inputqueue, outputqueue):
+    def __init__(self, inputqueue, outputqueue, parsepool=None):
         threading.Thread.__init__(self)
         self._inputqueue = inputqueue
         self._outputqueue = outputqueue
+        self._parsepool = parsepool
 
     def run(self):
         """ Request article from Wikipedia and put data on outputqueue. Each input will require one request, UNLESS
@@ -30,68 +29,76 @@ class Requests(threading.Thread):
             [ None, [(None, title_of_disambig_page)]]
         If we are requesting the linked articles of an article, the data would look as follows:
             [ parent, [(link_name, title), ...]]
-        Puts instances of Article on output queue.
+        For each input, puts a tuple (articles, error) on output queue, where articles is a list of the parsed
+        instances of Article and error is None. The articles are parsed in parsepool if it was given. If getting or
+        parsing the articles raised an exception, articles is empty and error is the exception, so that it can be
+        raised again in the main thread.
         """
         while True:
             parent, linkname_title = self._inputqueue.get()
-
-            # Split the requested titles by type. There are three types:
-            #   1. simple title that requests an article (i.e Fever)
-            #   2. a section in an article (i.e Fever#Types)
-            #   3. a section in the containing article (#Types). If this type is passed in, parent cannot be None.
-            #      A link of the form #section will be normalized to article#section where article=parent.
-            # Note: The same title can be passed in with different linknames.
-            simpletitles = defaultdict(list)
-            titlesection = defaultdict(list)
-            for linkname, title in linkname_title:
-                hashtagExists = title.find('#')
-
-                if hashtagExists == -1:  # no '#' in title
-                    simpletitles[title].append(linkname)
-                elif hashtagExists == 0: # '#' is first element
-                    if parent is None:
-                        raise ValueError('A title of the form #section was put on queue with no parent')
-                    newtitle = parent.get_title() + title
-                    titlesection[newtitle].append(linkname)
-                elif hashtagExists > 0: # '#' is not the first element
-                    titlesection[title].append(linkname)
-
             articles = []
-            # Get articles for the simple titles
-            # If there is no parent, get the entire article. Otherwise, get only the first section.
-            if parent is None:
-                simparticles = disamwiki.get_articles(simpletitles.keys(), section=None)
-            else:
-                simparticles = disamwiki.get_articles(simpletitles.keys(), section=0)
-            if simparticles is not None:
-                articles.extend(simparticles)
-
-            # For each request of the form article#section
-            for ts in titlesection:
-                articletitle, hashtag, sectiontitle = ts.partition('#')
-                article = disamwiki.get_article_fragment(articletitle, sectiontitle)
-                articles.append(article)
+            error = None
+            try:
+                articles = self._get_articles(parent, linkname_title)
+            except Exception as e:
+                error = e
+            finally:
+                self._outputqueue.put((articles, error))
+
+    def _get_articles(self, parent, linkname_title):
+        """ Request and parse the articles for one input of the inputqueue (see run). Returns the list of articles. """
+        # Split the requested titles by type. There are three types:
+        #   1. simple title that requests an article (i.e Fever)
+        #   2. a section in an article (i.e Fever#Types)
+        #   3. a section in the containing article (#Types). If this type is passed in, parent cannot be None.
+        #      A link of the form #section will be normalized to article#section where article=parent.
+        # Note: The same title can be passed in with different linknames.
+        simpletitles = defaultdict(list)
+        titlesection = defaultdict(list)
+        for linkname, title in linkname_title:
+            hashtagExists = title.find('#')
+
+            if hashtagExists == -1:  # no '#' in title
+                simpletitles[title].append(linkname)
+            elif hashtagExists == 0: # '#' is first element
+                if parent is None:
+                    raise ValueError('A title of the form #section was put on queue with no parent')
+                newtitle = parent.get_title() + title
+                titlesection[newtitle].append(linkname)
+            elif hashtagExists > 0: # '#' is not the first element
+                titlesection[title].append(linkname)
+
+        articles = []
+        # Get articles for the simple titles
+        # If there is no parent, get the entire article. Otherwise, get only the first section.
+        if parent is None:
+            simparticles = disamwiki.get_articles(list(simpletitles), section=None)
+        else:
+            simparticles = disamwiki.get_articles(list(simpletitles), section=0)
+        if simparticles is not None:
+            articles.extend(simparticles)
 
-            # Set the parent's children and set the parent of the children
-            if parent is not None:
-                st_article = {a.get_search_title(): a for a in articles}
-                searchtitles = dict(simpletitles, **titlesection)
-                for searchtitle, linknamelist in searchtitles.iteritems():
-                    article = st_article[searchtitle]   # the article that was requested by titles in linknamelist
-                    article.set_parent(parent)
-                    parent.add_children(article, linknamelist)
+        # Get articles for the requests of the form article#section
+        articles.extend(disamwiki.get_article_fragments(list(titlesection)))
 
-            # put each individual article on output queue
-            for article in articles:
-                self._outputqueue.put(article)
+        # Set the parent's children and set the parent of the children
+        if parent is not None:
+            st_article = {a.get_search_title(): a for a in articles}
+            searchtitles = {**simpletitles, **titlesection}
+            for searchtitle, linknamelist in searchtitles.items():
+                article = st_article[searchtitle]   # the article that was requested by titles in linknamelist
+                article.set_parent(parent)
+                parent.add_children(article, linknamelist)
 
-            self._inputqueue.task_done()
+        # parse the articles
+        disamwiki.parse_articles(articles, self._parsepool)
+        return articles
 
 
 ## Putting pages on queue ##
 def feed_disambig_title(queue, term):
     disambig_title = term + " (disambiguation)"
-    feed_titles(queue, [(None, disambig_title)], parent=None)
+    return feed_titles(queue, [(None, disambig_title)], parent=None)
 
 
 def feed_titles(queue, request, parent=None):
@@ -101,12 +108,17 @@ def feed_titles(queue, request, parent=None):
     request: list of (linkName, title) to put on queue, where linkname is the link as it appeared on the
     Wikipedia page and title is the title to request. linkName can be None.
     parent: parent of the requests (the titles are the parent article's links)
+    return: number of chunks put on the queue
     """
-    chunk_num = 5
+    chunk_num = 50  # maximum number of titles per API query
 
     # populate inputqueue with data
+    numchunks = 0
     for requestgroup in chunks(request, chunk_num):
         queue.put([parent] + [requestgroup])
+        numchunks += 1
+
+    return numchunks
 
 
 ## Miscellaneous functions ##
@@ -118,23 +130,33 @@ def chunks(l, n):
 
 def print_and_flush(string):
     """ Print string to stdout and then immediately flush the stdout stream. """
-    sys.stdout.write(string.encode('utf-8'))
+    sys.stdout.buffer.write(string.encode('utf-8'))
     sys.stdout.flush()
 
 
 def print_progress(numPagesRecieved, numPagesSent):
     """ Print progress based on the number of pages recieved and the total number of pages sent. """
     percent = (numPagesRecieved/numPagesSent) * 100
-    print_and_flush(u'\rArticles processed: {:5.2f}% ({}/{})'.format(percent, numPagesRecieved, numPagesSent))
+    print_and_flush('\rArticles processed: {:5.2f}% ({}/{})'.format(percent, numPagesRecieved, numPagesSent))
 
 
 ## Writing articles to file ##
+# Translation table used to turn titles and link names into folder and file names
+_NORM_TABLE = str.maketrans({' ': '_', '/': '-'})
+
+
 class FileExistsErr(Exception):
     def __init__(self, filename):
         Exception.__init__(self, filename)
         self.filename = filename
 
 
+def write_text(filename, text):
+    """ Write text to filename encoded as UTF-8. """
+    with open(filename, 'wb') as file:
+        file.write(text.encode('utf-8'))
+
+
 def write_files(article, overwrite=False, path=None):
     """ Recursively write articles to file. The folder name will be the title of a link (as it appears in article), and
     the *.txt files in the folder will contain the titles of the articles that were linked with given link name. If the
@@ -148,57 +170,51 @@ def write_files(article, overwrite=False, path=None):
     """
     # Write root article to file
     if article.parent is None:
-        title = article.get_title().replace(" ", "_").replace('/', '-')
+        title = article.get_title().translate(_NORM_TABLE)
         foldername = title
-        filename = u'{}/{}.txt'.format(foldername, title)
+        filename = '{}/{}.txt'.format(foldername, title)
         # If file exists and overwrite is False raise FileExistsErr
         if overwrite is False and os.path.isfile(filename):
             raise FileExistsErr(filename)
         # Create folder if it doesn't exist
-        if os.path.isdir(foldername) is False:
-            os.mkdir(foldername)
+        os.makedirs(foldername, exist_ok=True)
         # Write file
-        file = open(filename, 'w')
-        file.write(article.get_plaintext().encode('utf-8'))
-        file.close()
+        write_text(filename, article.get_plaintext())
         # Set the path.
-        path = article.get_title().replace(" ", "_").replace('/', '-')
+        path = title
 
     # Each article will be placed in a folder titled by the link name that linked the article. The contents of the article
     # are placed in this folder with a *.txt file of the article's contents. The *.txt file is named after the actual
     # article title as it appears on Wikipedia. If the same link appeared multiple times in an article, each folder
     # other than the first will be named linkname_i, where i is 2, 3, etc.
-    for linkname, children in article.get_children().iteritems():
-        normlinkname = linkname.replace(" ", "_").replace('/', '-')
+    for linkname, children in article.get_children().items():
+        normlinkname = linkname.translate(_NORM_TABLE)
 
         for i in range(len(children)):
             # Set the name of the folder
             if i == 0:      # first article linked by linkname
-                foldername = u'{}/{}'.format(path, normlinkname)
+                foldername = '{}/{}'.format(path, normlinkname)
             else:           # all other article linked by linkname
-                foldername = u'{}/{}_{}'.format(path, normlinkname, i+1)
+                foldername = '{}/{}_{}'.format(path, normlinkname, i+1)
 
             # Set filename. If the article was found, the filename will be the title, otherwise it will be the searched title
             if children[i].missing():
-                title = children[i].get_search_title().replace(" ", "_").replace('/', '-')
+                title = children[i].get_search_title().translate(_NORM_TABLE)
             else:
-                title = children[i].get_title().replace(" ", "_").replace('/', '-')
-            filename = u'{}/{}.txt'.format(foldername, title)
+                title = children[i].get_title().translate(_NORM_TABLE)
+            filename = '{}/{}.txt'.format(foldername, title)
 
             # Create folder if it doesn't exist
-            if os.path.isdir(foldername) is False:
-                os.mkdir(foldername)
+            os.makedirs(foldername, exist_ok=True)
             # If file exists and overwrite is False raise FileExistsErr
             if overwrite is False and os.path.isfile(filename):
                 raise FileExistsErr(filename)
 
             # Write file. If the article was never found, the file will say "DOES NOT EXIST"
-            file = open(filename, 'w')
             if children[i].missing():
-                file.write(u'DOES NOT EXIST')
+                write_text(filename, 'DOES NOT EXIST')
             else:
-                file.write(children[i].get_plaintext().encode('utf-8'))
-            file.close()
+                write_text(filename, children[i].get_plaintext())
 
             write_files(children[i], overwrite=overwrite, path=foldername)
 
@@ -207,29 +223,33 @@ def draw_article_tree(articlelist):
     import pygraphviz as pgv
 
     # Each key in titleToArticles is an article title, and the value is a list containing all articles with given title
-    titleToArticles = dict()
+    titleToArticles = defaultdict(list)
     for article in articlelist:
-        title = article.get_title()
-        if title in titleToArticles:
-            titleToArticles[title].append(article)
+        titleToArticles[article.get_title()].append(article)
+
+    # Split the titles into titles of articles with more than one incoming link (dups) and all other titles
+    dups = dict()
+    singletitles = []
+    for title, artlist in titleToArticles.items():
+        if len(artlist) > 1:
+            dups[title] = artlist
         else:
-            titleToArticles[title] = [article]
+            singletitles.append(title)
 
     D = pgv.AGraph(strict=False, directed=True)
-    dups = {title: artlist for (title, artlist) in titleToArticles.iteritems() if len(artlist) > 1}
 
 
     # Set nodes for articles with more than one incoming link to be orange and put them in graph.
     D.add_nodes_from(dups.keys(), fillcolor='darkorange1', style='filled')
 
-    visited = []
+    visited = set()
     # Set the parents for all of the articles with multiple incoming links.
     for title in dups:
         duparticles = dups[title]
 
         for article in duparticles:
             D.add_edge(article.parent.get_title(), title, label=article.get_link_title(), color='blue')
-        visited.append(title)
+        visited.add(title)
 
     # Starting at the articles with multiple links, make sure there is a path to the root node
     for title in dups:
@@ -243,20 +263,18 @@ def draw_article_tree(articlelist):
                 if node.get_title() in visited:
                     break
                 D.add_edge(node.parent.get_title(), node.get_title(), label=node.get_link_title(), color='green')
-                visited.append(node.get_title())
+                visited.add(node.get_title())
 
     #
     # Graph of all nodes
     G = pgv.AGraph(strict=False, directed=True)
-    duplicatetitles = [t for t in titleToArticles if len(titleToArticles[t]) > 1]
-    singletitles = [t for t in titleToArticles if len(titleToArticles[t]) <= 1]
-    G.add_nodes_from(duplicatetitles, fillcolor='darkorange1', style='filled')
+    G.add_nodes_from(dups.keys(), fillcolor='darkorange1', style='filled')
     G.add_nodes_from(singletitles)
 
 
     for article in articlelist:
         for child in article:
-            if child.get_title() in duplicatetitles:
+            if child.get_title() in dups:
                 G.add_edge(article.get_title(), child.get_title(), label=child.get_link_title(), color='blue')
             else:
                 G.add_edge(article.get_title(), child.get_title(), label=child.get_link_title())
@@ -307,60 +325,62 @@ if __name__ == '__main__':
     NUM_LINKS = [args.num_disambig_links] + [args.num_page_links] * (MAX_LEVEL-1)
     OVERWRITE_FILES = args.overwrite
 
-    requests_input_queue = Queue.Queue()
-    requests_output_queue = Queue.Queue()
+    requests_input_queue = queue.Queue()
+    requests_output_queue = queue.Queue()
+
+    # one thread per pooled connection in disamwiki
+    request_threads = 32
 
-    request_threads = 15
+    # Articles are parsed in separate processes so that parsing is not limited to one core. The pool is created
+    # before the requests threads are started.
+    parse_pool = multiprocessing.Pool(processes=multiprocessing.cpu_count())
 
     # create requests threads
     for i in range(request_threads):
-        producer = Requests(requests_input_queue, requests_output_queue)
+        producer = Requests(requests_input_queue, requests_output_queue, parse_pool)
         producer.daemon = True
         producer.start()
 
     # populate requests_input_queue with disambiguation page title
-    feed_disambig_title(requests_input_queue, TERM)
-
-    # main thread sleeps so Request threads can get started
-    time.sleep(0.5)
+    numpendingrequests = feed_disambig_title(requests_input_queue, TERM)
 
     numpagessent = 1       # 1 since we already sent disambiguation title
     recievedarticles = []
-    # event loop: gets articles output by threads
-    while True:
-        try:
-            article = requests_output_queue.get(timeout=3)
-            article.parse()
+    # event loop: gets the articles output by threads for each request. Every request put on requests_input_queue
+    # is answered exactly once, either with its articles or with the error that occurred, so the loop either ends
+    # when all requests have been answered or raises the first error.
+    while numpendingrequests > 0:
+        articles, error = requests_output_queue.get()
+        numpendingrequests -= 1
+        # If a requests thread failed, raise its exception here
+        if error is not None:
+            raise error
+
+        for article in articles:
             level = article.get_level()
 
             # if the article was missing, continue
             if article.missing():
-                requests_output_queue.task_done()
                 continue
 
             # put the linked articles in queue for Requests threads
             if level < MAX_LEVEL:
                 links = article.get_links(NUM_LINKS[level])
-                numlinks = len(links)
-                feed_titles(requests_input_queue, links, parent=article)
-                numpagessent += numlinks
+                numpendingrequests += feed_titles(requests_input_queue, links, parent=article)
+                numpagessent += len(links)
 
             recievedarticles.append(article)
-        except Queue.Empty:  # exception will be raised when get call times out
-            # Wait for all current threads to finish
-            requests_input_queue.join()
 
-            # If all threads joined and the output queue is empty, we are done
-            if requests_output_queue.empty():
-                print_and_flush('\n')
-                break
+            # print progress information
+            print_progress(len(recievedarticles), numpagessent)
+    print_and_flush('\n')
 
-        # print progress information
-        print_progress(len(recievedarticles), numpagessent)
+    parse_pool.close()
+    parse_pool.join()
 
     # if the disambiguation page could not be found
     if len(recievedarticles) == 0:
-        print_and_flush(u'No disambiguation page was found for {}\n'.format(TERM))
+        print_and_flush('No disambiguation page was found for {}\n'.format(TERM))
     else:
         # find the root node
         root = None
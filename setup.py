@@ -0,0 +1,11 @@
+# setup.py
+#
+# Builds the optional compiled extension used by disamwiki. Requires Cython.
+#   python setup.py build_ext --inplace
+
+from setuptools import setup
+from Cython.Build import cythonize
+
+
+setup(name='disamwiki',
+      ext_modules=cythonize('disamwiki_fast.pyx', compiler_directives={'language_level': 3}))